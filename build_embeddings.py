@@ -0,0 +1,53 @@
+# build_embeddings.py
+# Precomputes the clause embedding files that clauseiq_app.py loads at startup, so deployed
+# app processes never run MiniLM over the clause database. Run it and commit the embeddings/
+# directory it writes, again whenever the clause list changes; the app ignores files whose
+# fingerprint no longer matches and encodes at startup instead.
+#
+#   python build_embeddings.py [--onnx-file onnx/model_quint8_avx2.onnx ...]
+#
+# Writes one file per int8 ONNX export the app can pick for its host CPU (ONNX Runtime runs
+# all of them anywhere), so the output matches on AVX2, AVX512-VNNI and ARM64 hosts.
+# Hosts that override ONNX_MODEL_FILE or fall back to PyTorch still work, they just encode
+# at startup as before.
+
+import argparse
+import ast
+import os
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from clause_embeddings import EMBEDDINGS_FILE, ONNX_INT8_FILES, PREBUILT_DIR, clause_fingerprint, onnx_variant
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clauseiq_app.py")
+
+def read_clauses():
+    """Reads the `clauses` list literal from clauseiq_app.py without importing (and running) the Streamlit app."""
+    with open(APP_PATH, encoding="utf-8") as f: # The app contains emoji; don't depend on the locale's codec
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "clauses" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise SystemExit("No `clauses = [...]` list found in clauseiq_app.py")
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute ClauseIQ clause embeddings.")
+    parser.add_argument("--onnx-file", action="append", dest="onnx_files",
+                        help="ONNX export to encode with (repeatable; default: every int8 export)")
+    args = parser.parse_args()
+
+    clauses = read_clauses()
+    os.makedirs(PREBUILT_DIR, exist_ok=True)
+    for onnx_file in args.onnx_files or ONNX_INT8_FILES:
+        model = SentenceTransformer("all-MiniLM-L6-v2", backend="onnx", model_kwargs={"file_name": onnx_file})
+        model.max_seq_length = 128 # Same cap as load_model()
+        emb = model.encode(clauses, batch_size=64, show_progress_bar=False,
+                           convert_to_numpy=True, normalize_embeddings=True)
+
+        name = EMBEDDINGS_FILE.format(fingerprint=clause_fingerprint(onnx_variant(onnx_file), clauses))
+        np.save(os.path.join(PREBUILT_DIR, name), emb.astype(np.float16))
+        print(f"Wrote {len(clauses)} clause embeddings for {onnx_file} to embeddings/{name}")
+
+if __name__ == "__main__":
+    main()
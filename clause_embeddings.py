@@ -0,0 +1,29 @@
+# clause_embeddings.py
+# Naming for persisted clause embeddings, shared by clauseiq_app.py and build_embeddings.py so the
+# files the build script commits are exactly the ones the app looks up. Kept free of Streamlit and
+# model imports so the build script can use it on its own.
+
+import hashlib
+import json
+import os
+
+# build_embeddings.py writes here, for committing with the app (until then the directory may not exist);
+# runtime copies go next to the app (git-ignored).
+PREBUILT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embeddings")
+EMBEDDINGS_FILE = "clauses-{fingerprint}.f16.npy"
+
+# Every int8 export default_onnx_file() in clauseiq_app.py can pick; build_embeddings.py emits a file for each.
+ONNX_INT8_FILES = (
+    "onnx/model_quint8_avx2.onnx",
+    "onnx/model_qint8_avx512_vnni.onnx",
+    "onnx/model_qint8_arm64.onnx",
+)
+
+def onnx_variant(onnx_file):
+    """Names the embedding model variant for an ONNX export of all-MiniLM-L6-v2."""
+    return f"onnx:{onnx_file}"
+
+def clause_fingerprint(variant, clauses):
+    """Short content hash of the clauses plus the model variant that encodes them."""
+    key = json.dumps([variant, list(clauses)])
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
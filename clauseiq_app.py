@@ -3,15 +3,38 @@
 # Now using Google Gemini API for LLM decisions, with Firebase for Authentication.
 
 import streamlit as st
-from sentence_transformers import SentenceTransformer
-import faiss
+import os
+import platform
+import numpy as np
 import json
+import re
+import tempfile
+import time
+import threading
+from collections import OrderedDict
 import requests # For making HTTP requests to the Gemini API
 
+# orjson parses and serializes in C; fall back to the stdlib if it isn't installed.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing except clauses still apply.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumpb = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumpb(obj):
+        return json.dumps(obj).encode()
+
+from clause_embeddings import EMBEDDINGS_FILE, PREBUILT_DIR, clause_fingerprint, onnx_variant
+
 # Firebase Imports for Authentication and Firestore
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # --- Firebase Initialization ---
 # This block initializes Firebase only once per Streamlit app run.
 # It uses credentials provided by the Canvas environment.
@@ -29,7 +52,14 @@ if not firebase_admin._apps:
         st.error(f"Error initializing Firebase: {e}")
         st.session_state.firebase_initialized = False
 
-db = firestore.client() # Initialize Firestore client
+@st.cache_resource
+def get_db():
+    """
+    Returns the Firestore client, created once per process on first use.
+    Call it from code paths that read or write Firestore, after Firebase has been initialized;
+    the login page never needs the client, so startup no longer opens its gRPC channel.
+    """
+    return firestore.client()
 
 # --- Streamlit Session State for Authentication ---
 if 'logged_in' not in st.session_state:
@@ -38,13 +68,114 @@ if 'user_id' not in st.session_state:
     st.session_state.user_id = None
 if 'auth_error' not in st.session_state:
     st.session_state.auth_error = ""
+st.session_state.setdefault("auth_attempted", False) # Automatic token sign-in runs at most once per session
 
 # --- Load LLM and Embedding Model ---
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# "onnx" runs the int8-quantized ONNX export of MiniLM on ONNX Runtime. "torch" (also the fallback if ONNX fails to
+# load) is the PyTorch model, but not fp32: Linear layers are int8 dynamically quantized on CPU, fp16 on GPU.
+EMBEDDING_BACKEND = st.secrets.get("EMBEDDING_BACKEND", "onnx")
+EMB_DIM = 384 # all-MiniLM-L6-v2 output size; fixes FAISS index and cache buffer shapes
+
+@st.cache_resource
+def default_onnx_file():
+    """Picks the int8 export built for the host CPU: ARM64, else AVX512-VNNI where supported, else AVX2."""
+    if platform.machine().lower() in ("arm64", "aarch64"): # Graviton, Apple Silicon
+        return "onnx/model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as f:
+            if "avx512_vnni" in f.read():
+                return "onnx/model_qint8_avx512_vnni.onnx"
+    except OSError:
+        pass # No /proc/cpuinfo (not Linux): assume an x86-64 host without VNNI
+    return "onnx/model_quint8_avx2.onnx"
+
+# Exports shipped in the all-MiniLM-L6-v2 model repo: int8-quantized by default; the graph-optimized
+# fp32 variants (e.g. "onnx/model_O2.onnx", with fused attention) can be selected via secrets.
+ONNX_MODEL_FILE = st.secrets.get("ONNX_MODEL_FILE") or default_onnx_file()
+
+@st.cache_resource
+def load_model():
+    """
+    Loads the sentence embedding model once per process.
+    st.cache_resource keeps the instance alive across script reruns and sessions,
+    so widget interactions no longer reload the weights from disk.
+    Falls back to the PyTorch model if the ONNX backend is unavailable.
+    The heavy imports live here so the page renders before torch is loaded.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # PyTorch's intra-op pool is often left at 1 thread on hosted containers; use every core for encode.
+    torch.set_num_threads(os.cpu_count() or 4)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        pass # Can only be set once per process, before any parallel work has started
+    m = None
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            m = SentenceTransformer("all-MiniLM-L6-v2", backend="onnx", model_kwargs={"file_name": ONNX_MODEL_FILE})
+        except Exception as e:
+            st.warning(f"ONNX embedding backend unavailable, using PyTorch instead: {e}")
+    if m is None:
+        m = SentenceTransformer("all-MiniLM-L6-v2")
+        if torch.cuda.is_available():
+            m = m.half() # FP16 on GPU: half the weight bandwidth, only slight changes to the embeddings
+        else:
+            # int8 dynamic quantization of the Linear layers: ~4x smaller weights and int8 GEMM on CPU
+            m[0].auto_model = torch.ao.quantization.quantize_dynamic(m[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8)
+    # Inputs are single clauses or short claim descriptions; capping the length bounds the O(L^2) attention
+    # cost of an unusually long query. Shorter inputs are unaffected, since batches pad to their longest entry.
+    m.max_seq_length = 128
+    # The Rust "fast" tokenizer is much quicker than the Python one on short queries; make sure we got it.
+    if not m.tokenizer.is_fast:
+        from transformers import AutoTokenizer
+        m.tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/all-MiniLM-L6-v2", use_fast=True)
+    return m
 
 # --- Gemini API Configuration ---
 GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"] # Assuming the secret is named GEMINI_API_KEY
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent"
+GEMINI_BATCH_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:batchGenerateContent"
+
+@st.cache_resource
+def get_http():
+    """Returns a process-wide requests.Session so Gemini calls reuse pooled keep-alive connections."""
+    s = requests.Session()
+    s.headers.update({'Content-Type': 'application/json'})
+    # pool_maxsize bounds concurrent connections per host; sized for several sessions querying at once
+    a = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    s.mount("https://", a)
+    return s
+
+# The static instructions go in Gemini's systemInstruction field; only the query and the
+# matched clauses vary per call and are sent as the user turn.
+SYSTEM_PROMPT = """
+You are an insurance claim reasoning assistant.
+Based on the clauses and query, respond with a JSON containing:
+- decision: approved or rejected
+- reason: short explanation
+- counterclause: any alternate way the user might still be approved
+- clause_reference: the clause(s) used
+
+Respond only with JSON.
+"""
+PROMPT_TMPL = """
+User Query: "{q}"
+Relevant Clauses:
+{ctx}
+"""
+
+# Request-body parts that never change; build_payload shares them instead of rebuilding them per call.
+SYSTEM_INSTRUCTION = {
+    "parts": [
+        {"text": SYSTEM_PROMPT}
+    ]
+}
+GENERATION_CONFIG = {
+    "responseMimeType": "application/json"
+}
 
 # --- Sample Clause Database ---
 clauses = [
@@ -52,48 +183,278 @@ clauses = [
     "Clause 3.2: Surgery due to accident may be exempt from waiting period.",
     "Clause 6.4: Portability clause allows prior policy duration to be counted."
 ]
+clauses_arr = np.array(clauses, dtype=object) # Lets search results be gathered with one fancy-index call
 
-embeddings = model.encode(clauses)
-index = faiss.IndexFlatL2(len(embeddings[0]))
-index.add(embeddings)
+# Clause embeddings persisted as float16; later process starts load them instead of running the model.
+# File names carry a fingerprint of the clause text and embedding model, so edits never reuse stale vectors.
+# build_embeddings.py precomputes these files into PREBUILT_DIR; once its output is committed, deploys skip the
+# encode. Anything not found there is encoded on first use and kept next to the app.
+def embedding_variant(model):
+    """
+    Names the weights that actually loaded. When the ONNX load fails, load_model() falls back to PyTorch,
+    whose vectors must not be stored or reused under the ONNX export's name.
+    """
+    if model.backend == "onnx":
+        return onnx_variant(ONNX_MODEL_FILE)
+    return "torch-fp16" if model.device.type == "cuda" else "torch-int8"
+
+def write_atomic(path, write):
+    """
+    Calls write(tmp_path) on a temp file next to path, then renames it into place, so a crash or a
+    concurrent worker never leaves a half-written file where the next start would load it.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix="-" + os.path.basename(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+@st.cache_resource
+def build_index(clauses_tuple):
+    """
+    Embeds the clause database once per process.
+    Takes a tuple so the clause list can be used as the cache key.
+    Embeddings are L2-normalized, so a plain dot product gives cosine similarity;
+    for a corpus this small a matrix product beats building a FAISS index.
+    """
+    name = EMBEDDINGS_FILE.format(fingerprint=clause_fingerprint(embedding_variant(load_model()), clauses_tuple))
+    path = os.path.join(APP_DIR, name)
+    for candidate in (os.path.join(PREBUILT_DIR, name), path):
+        try:
+            stored = np.load(candidate)
+            if stored.shape == (len(clauses_tuple), EMB_DIM):
+                return stored.astype(np.float32) # float16 on disk, float32 for the BLAS matmul
+        except (OSError, ValueError, EOFError):
+            pass # Missing or unreadable: treat it as a cache miss, re-encode and rewrite the runtime copy
+    # encode() already sorts sentences by length before batching, so one call keeps padding minimal
+    emb = load_model().encode(list(clauses_tuple), batch_size=64, show_progress_bar=False,
+                              convert_to_numpy=True, normalize_embeddings=True)
+    assert emb.shape[1] == EMB_DIM, f"Embedding model returned {emb.shape[1]}-d vectors, expected {EMB_DIM}"
+    try:
+        write_atomic(path, lambda tmp: np.save(tmp, emb.astype(np.float16)))
+    except OSError:
+        pass # Read-only filesystem: keep the in-memory embeddings and re-encode on the next start
+    return np.ascontiguousarray(emb, dtype=np.float32)
+
+# Clause databases larger than ANN_MIN_CLAUSES are searched through a FAISS index instead of a brute-force
+# matmul: HNSW (O(log N) per query) up to IVFPQ_MIN_CLAUSES, then OPQ + IVF-PQ, which also compresses vectors.
+ANN_MIN_CLAUSES = 1024
+IVFPQ_MIN_CLAUSES = 10_000
+CLAUSE_INDEX_PATH = os.path.join(APP_DIR, "clauses-{fingerprint}.faiss")
+
+def tune_ann_index(index):
+    """Sets the query-time search breadth for either index type."""
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = 64
+    else:
+        faiss.extract_index_ivf(index).nprobe = 16
+    return index
+
+@st.cache_resource
+def build_ann_index(clauses_tuple):
+    """
+    Builds a FAISS index over the clause embeddings, for large clause databases.
+    Below IVFPQ_MIN_CLAUSES this is an HNSW graph over int8-quantized vectors; above it, an OPQ-rotated IVF-PQ
+    index that stores each vector as 16 one-byte PQ codes and only scans the nprobe closest lists.
+    """
+    import faiss
+
+    path = CLAUSE_INDEX_PATH.format(fingerprint=clause_fingerprint(embedding_variant(load_model()), clauses_tuple))
+    if os.path.exists(path):
+        try:
+            # Loading skips the encode + build. IO_FLAG_MMAP maps the IVF-PQ inverted lists, so those pages are
+            # shared between worker processes; an HNSW index is still read fully into memory.
+            return tune_ann_index(faiss.read_index(path, faiss.IO_FLAG_MMAP))
+        except RuntimeError:
+            pass # Unreadable index file: rebuild it below and overwrite it
+    emb = build_index(clauses_tuple)
+    d = EMB_DIM
+    if len(emb) <= IVFPQ_MIN_CLAUSES:
+        # int8 scalar-quantized storage: 4x smaller than float32, so graph traversal moves a quarter of the bytes
+        index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 100
+        index.train(emb)
+    else:
+        nlist = min(4096, max(64, len(emb) // 39)) # FAISS wants at least 39 training points per list
+        quantizer = faiss.IndexFlatIP(d)
+        ivf = faiss.IndexIVFPQ(quantizer, d, nlist, 16, 8, faiss.METRIC_INNER_PRODUCT)
+        index = faiss.IndexPreTransform(faiss.OPQMatrix(d, 16), ivf)
+        index.train(emb)
+    index.add(emb)
+    tune_ann_index(index)
+    try:
+        write_atomic(path, lambda tmp: faiss.write_index(index, tmp))
+    except (RuntimeError, OSError):
+        pass # FAISS reports I/O failures as RuntimeError; keep serving from the in-memory index
+    return index
 
 # --- Helper Functions ---
+@st.cache_data(max_entries=1024)
+def encode_query(user_query):
+    """
+    Embeds a user query. Cached per query string, so reruns triggered by other
+    widgets (e.g. the LawyerConnect buttons) skip the model forward pass.
+    """
+    import torch
+
+    model = load_model()
+    with torch.inference_mode(): # Skips autograd version-counter bookkeeping, cheaper than no_grad
+        vec = model.encode([user_query], convert_to_numpy=True, normalize_embeddings=True)[0]
+    return np.ascontiguousarray(vec, dtype=np.float32) # 1-D float32, so scoring is a single sgemv
+
+def top_k(scores, k):
+    """
+    Returns the indices of the k highest scores, best first.
+    argpartition finds them without a full sort; argsort then orders just those k.
+    """
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+@st.cache_data(max_entries=1024, show_spinner=False)
 def get_top_clause(user_query):
     """
     Finds the top 2 most similar clauses from the database based on the user's query.
     """
-    query_vec = model.encode([user_query])
-    D, I = index.search(query_vec, k=2)
-    return [clauses[i] for i in I[0]]
+    query_vec = encode_query(user_query)
+    if len(clauses) > ANN_MIN_CLAUSES:
+        _, I = build_ann_index(tuple(clauses)).search(query_vec.reshape(1, -1), 2)
+        return clauses_arr[I[0][I[0] >= 0]].tolist() # FAISS pads missing results with -1
+    embeddings = build_index(tuple(clauses))
+    scores = embeddings @ query_vec
+    return clauses_arr[top_k(scores, 2)].tolist()
+
+# --- LLM Decision Cache ---
+# Streamed responses are only complete once fully consumed, so st.cache_data can't wrap them;
+# this process-wide LRU stores the finished decision JSON instead.
+DECISION_CACHE_TTL = 3600 # Seconds
+DECISION_CACHE_MAX_ENTRIES = 512
+
+@st.cache_resource
+def get_decision_cache():
+    """Returns the shared (entries, lock) pair; entries maps (query, clauses) -> (timestamp, decision JSON)."""
+    return OrderedDict(), threading.Lock()
+
+def cache_lookup(key):
+    """Returns the cached decision JSON for key, or None if missing or expired."""
+    entries, lock = get_decision_cache()
+    with lock:
+        hit = entries.get(key)
+        if hit is None or time.time() - hit[0] > DECISION_CACHE_TTL:
+            return None
+        entries.move_to_end(key)
+        return hit[1]
+
+def cache_store(key, decision):
+    """Stores a decision, evicting the least recently used entries past the size cap."""
+    entries, lock = get_decision_cache()
+    with lock:
+        entries[key] = (time.time(), decision)
+        entries.move_to_end(key)
+        while len(entries) > DECISION_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+# Paraphrased queries ("mom's breast surgery at 3 months" vs "mother's breast operation after 3 months")
+# miss the exact-match cache; this one matches on query embedding instead.
+SEMANTIC_CACHE_THRESHOLD = 0.95 # Minimum cosine similarity to reuse a cached decision
+SEMANTIC_CACHE_MAX_ENTRIES = 10_000
+# Decisions hinge on durations, dates and negations ("after 3 months" vs "after 5 months", "started in January"
+# vs "started in March", "accident" vs "not an accident") that barely move the embedding, so a paraphrase only
+# counts as one if it mentions the same numbers, months and negations.
+KEY_TERMS_RE = re.compile(
+    r"\d+(?:\.\d+)?"
+    r"|\b(?:one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve)\b"
+    r"|\b(?:january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug"
+    r"|september|sept|sep|october|oct|november|nov|december|dec)\b"
+    r"|\b(?:not|no|never|without|none)\b|n't\b"
+)
+MONTH_NAMES = {"january", "february", "march", "april", "june", "july", "august", "september",
+               "october", "november", "december", "sept"}
+
+def query_key_terms(user_query):
+    """
+    Returns the numbers (digits or words), months and negations in a query, in order.
+    Month names are cut to their abbreviation so "Jan" and "January" match.
+    """
+    return tuple(t[:3] if t in MONTH_NAMES else t for t in KEY_TERMS_RE.findall(user_query.lower()))
 
-def get_llm_decision(user_query, matched_clauses):
+@st.cache_resource
+def get_semantic_cache():
     """
-    Uses the Google Gemini API (gemini-2.0-flash) to make a decision
-    based on the user query and matched clauses.
+    Returns the shared paraphrase cache. Row i of "vecs" is a past query embedding;
+    entries[i] is its (timestamp, matched clauses, query key terms, decision) and last_used[i] drives LRU eviction.
     """
-    context = "\n".join(matched_clauses)
-    prompt = f"""
-You are an insurance claim reasoning assistant.
-User Query: "{user_query}"
-Relevant Clauses:
-{context}
+    return {"vecs": None, "entries": [], "last_used": np.zeros(SEMANTIC_CACHE_MAX_ENTRIES), "lock": threading.Lock()}
 
-Based on the clauses and query, respond with a JSON containing:
-- decision: approved or rejected
-- reason: short explanation
-- counterclause: any alternate way the user might still be approved
-- clause_reference: the clause(s) used
+def semantic_cache_lookup(query_vec, key_terms, matched_clauses):
+    """
+    Returns the decision cached for the most similar past query, if it is close enough,
+    has the same key terms (see query_key_terms) and used the same clauses.
+    """
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        n = len(cache["entries"])
+        if n == 0:
+            return None
+        sims = cache["vecs"][:n] @ query_vec
+        best = int(np.argmax(sims))
+        stored_at, stored_clauses, stored_terms, decision = cache["entries"][best]
+        expired = time.time() - stored_at > DECISION_CACHE_TTL
+        if sims[best] < SEMANTIC_CACHE_THRESHOLD or stored_terms != key_terms or stored_clauses != matched_clauses or expired:
+            return None
+        cache["last_used"][best] = time.time()
+        return decision
+
+def semantic_cache_store(query_vec, key_terms, matched_clauses, decision):
+    """Adds a decision to the paraphrase cache, overwriting the least recently used row once full."""
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        if cache["vecs"] is None:
+            cache["vecs"] = np.empty((SEMANTIC_CACHE_MAX_ENTRIES, EMB_DIM), dtype=np.float32)
+        n = len(cache["entries"])
+        entry = (time.time(), matched_clauses, key_terms, decision)
+        if n < SEMANTIC_CACHE_MAX_ENTRIES:
+            i = n
+            cache["entries"].append(entry)
+        else:
+            i = int(np.argmin(cache["last_used"]))
+            cache["entries"][i] = entry
+        cache["vecs"][i] = query_vec
+        cache["last_used"][i] = time.time()
 
-Respond only with JSON.
-"""
+DECISION_FIELDS = ("decision", "reason", "counterclause", "clause_reference")
 
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    params = {
-        'key': GEMINI_API_KEY
-    }
-    payload = {
+def error_decision(reason):
+    """Returns the decision dict shown when Gemini could not produce a usable answer."""
+    return {"decision": "error", "reason": reason, "counterclause": "", "clause_reference": ""}
+
+def parse_decision(text):
+    """
+    Parses Gemini's decision JSON once and checks it carries every field the dashboard reads.
+    List values (Gemini often returns clause_reference as ["Clause 5.1", "Clause 3.2"]) are joined into one string.
+    Raises json.JSONDecodeError for malformed JSON and ValueError for a missing field.
+    """
+    decision = json_loads(text)
+    if not isinstance(decision, dict):
+        raise ValueError(f"Gemini decision is not a JSON object: {text}")
+    missing = [f for f in DECISION_FIELDS if f not in decision]
+    if missing:
+        raise ValueError(f"Gemini decision is missing required fields {missing}: {text}")
+    for f in DECISION_FIELDS:
+        if isinstance(decision[f], list):
+            decision[f] = ", ".join(str(v) for v in decision[f])
+    return decision
+
+def build_payload(user_query, matched_clauses):
+    """Builds the Gemini generateContent request body for a query and its matched clauses."""
+    prompt = PROMPT_TMPL.format_map({"q": user_query, "ctx": "\n".join(matched_clauses)})
+    return {
+        "systemInstruction": SYSTEM_INSTRUCTION,
         "contents": [
             {
                 "role": "user",
@@ -102,33 +463,135 @@ Respond only with JSON.
                 ]
             }
         ],
-        "generationConfig": {
-            "responseMimeType": "application/json"
-        }
+        "generationConfig": GENERATION_CONFIG
     }
 
-    try:
-        response = requests.post(GEMINI_API_URL, headers=headers, params=params, json=payload)
-        response.raise_for_status()
-        result = response.json()
+def stream_llm_decision(user_query, matched_clauses):
+    """
+    Uses the Google Gemini API (gemini-2.0-flash) to make a decision
+    based on the user query and matched clauses.
+    Yields the response text as it arrives over server-sent events.
+    Failures raise, so a partial response is never mistaken for a complete one.
+    """
+    params = {
+        'key': GEMINI_API_KEY,
+        'alt': 'sse'
+    }
+    payload = build_payload(user_query, matched_clauses)
 
-        if result.get('candidates') and result['candidates'][0].get('content') and result['candidates'][0]['content'].get('parts'):
-            json_string = result['candidates'][0]['content']['parts'][0]['text']
-            return json_string
-        else:
-            st.error(f"Gemini API response format unexpected: {result}")
-            return json.dumps({"decision": "error", "reason": "Unexpected API response format", "counterclause": "", "clause_reference": ""})
+    with get_http().post(GEMINI_STREAM_URL, params=params, data=json_dumpb(payload), stream=True, timeout=(3, 30)) as response:
+        response.raise_for_status()
+        # chunk_size=None yields data as it arrives; the default 512-byte reads would hold back short events
+        for line in response.iter_lines(chunk_size=None):
+            if not line.startswith(b"data:"):
+                continue
+            result = json_loads(line[len(b"data:"):])
+            if result.get('candidates') and result['candidates'][0].get('content') and result['candidates'][0]['content'].get('parts'):
+                yield result['candidates'][0]['content']['parts'][0]['text']
+            elif not result.get('candidates'):
+                raise ValueError(f"Gemini API response format unexpected: {result}")
+
+def get_llm_decision(user_query, matched_clauses, placeholder=None):
+    """
+    Returns the Gemini decision for the query as a dict, or an error decision if the call fails.
+    matched_clauses must be a tuple so it can be part of the cache key.
+    If a placeholder is given, the partial response is shown in it while streaming.
+    """
+    key = (user_query, matched_clauses)
+    cached = cache_lookup(key)
+    if cached is None:
+        query_vec = encode_query(user_query)
+        cached = semantic_cache_lookup(query_vec, query_key_terms(user_query), matched_clauses)
+    if cached is not None:
+        return cached
 
+    try:
+        text = ""
+        for chunk in stream_llm_decision(user_query, matched_clauses):
+            text += chunk
+            if placeholder is not None:
+                placeholder.code(text, language="json")
+        decision = parse_decision(text)
     except requests.exceptions.RequestException as e:
         st.error(f"Error calling Gemini API: {e}")
-        return json.dumps({"decision": "error", "reason": f"API call failed: {e}", "counterclause": "", "clause_reference": ""})
+        return error_decision(f"API call failed: {e}")
     except json.JSONDecodeError as e:
-        st.error(f"Error decoding JSON from Gemini API: {e}. Raw response: {response.text}")
-        return json.dumps({"decision": "error", "reason": f"Invalid JSON from API: {e}", "counterclause": "", "clause_reference": ""})
+        st.error(f"Error decoding JSON from Gemini API: {e}. Raw response: {e.doc}")
+        return error_decision(f"Invalid JSON from API: {e}")
+    except ValueError as e:
+        st.error(str(e))
+        return error_decision("Unexpected API response format")
+
+    cache_store(key, decision)
+    semantic_cache_store(query_vec, query_key_terms(user_query), matched_clauses, decision)
+    return decision
+
+def submit_batch_decision(queries):
+    """
+    Queues decisions for several queries as one Gemini Batch API job, billed at half the interactive price.
+    Only for latency-tolerant bulk work (see batch_decide); returns the batch name (e.g. "batches/123") to poll later.
+    Raises requests.exceptions.RequestException if the call fails and ValueError for an unexpected response.
+    """
+    batch_requests = [
+        {"request": build_payload(q, tuple(get_top_clause(q))), "metadata": {"key": q}}
+        for q in queries
+    ]
+    body = {
+        "batch": {
+            "display_name": "clauseiq-bulk-decisions",
+            "input_config": {"requests": {"requests": batch_requests}}
+        }
+    }
+    response = get_http().post(GEMINI_BATCH_URL, params={'key': GEMINI_API_KEY}, data=json_dumpb(body), timeout=(3, 30))
+    response.raise_for_status()
+    name = json_loads(response.content).get("name") # json.JSONDecodeError is a ValueError
+    if not name:
+        raise ValueError(f"Gemini batch response has no job name: {response.text}")
+    return name
+
+def get_batch_results(batch_name):
+    """
+    Polls a Gemini batch job. Returns None while it is still queued or running; once it succeeds,
+    a dict mapping each submitted query to its decision dict (an error decision for requests that failed).
+    """
+    response = get_http().get(GEMINI_API_BASE + batch_name, params={'key': GEMINI_API_KEY}, timeout=(3, 30))
+    response.raise_for_status()
+    batch = json_loads(response.content)
+    state = batch.get("metadata", {}).get("state")
+    if state in ("BATCH_STATE_PENDING", "BATCH_STATE_RUNNING"):
+        return None
+    if state != "BATCH_STATE_SUCCEEDED":
+        raise ValueError(f"Gemini batch {batch_name} ended in state {state}")
+
+    results = {}
+    for item in batch["response"]["inlinedResponses"]["inlinedResponses"]:
+        result = item.get("response", {})
+        if result.get('candidates') and result['candidates'][0].get('content') and result['candidates'][0]['content'].get('parts'):
+            text = result['candidates'][0]['content']['parts'][0]['text']
+            try:
+                results[item["metadata"]["key"]] = parse_decision(text)
+            except ValueError as e: # json.JSONDecodeError is a ValueError
+                results[item["metadata"]["key"]] = error_decision(f"Invalid decision from API: {e}")
+        else:
+            results[item["metadata"]["key"]] = error_decision(f"Batch request failed: {item.get('error')}")
+    return results
+
+def batch_decide(queries, poll_interval=30):
+    """
+    Bulk path for latency-tolerant workloads (e.g. re-scoring historical claims): submits one
+    batch job, blocks until it finishes, and returns the parsed decisions in query order.
+    """
+    batch_name = submit_batch_decision(queries)
+    while (results := get_batch_results(batch_name)) is None:
+        time.sleep(poll_interval)
+    return [results[q] for q in queries]
 
 # --- Authentication Functions (for UI simulation) ---
 def login_user(email, password):
-    """Simulates login. In a real app, this would use Firebase Auth."""
+    """
+    Simulates login. In a real app, this would use Firebase Auth.
+    Runs as the Login button's on_click callback, so the rerun Streamlit performs after it already shows the dashboard.
+    """
     st.session_state.auth_error = ""
     try:
         # In the Canvas environment, we rely on __initial_auth_token
@@ -136,10 +599,10 @@ def login_user(email, password):
         # For demonstration, we'll just check if the token exists.
         if st.session_state.firebase_initialized and '__initial_auth_token' in globals() and __initial_auth_token:
             # Simulate successful login if token is present
-            st.session_state.logged_in = True
+            # Verified on every Login click, so an expired or revoked token stops working after logout
             st.session_state.user_id = auth.verify_id_token(__initial_auth_token)['uid']
+            st.session_state.logged_in = True
             st.success(f"Logged in as {st.session_state.user_id}")
-            st.rerun()
         else:
             st.session_state.auth_error = "Login failed: No authentication token available. For real login, connect to Firebase Auth."
     except Exception as e:
@@ -163,162 +626,24 @@ def logout_user():
     st.session_state.logged_in = False
     st.session_state.user_id = None
     st.session_state.auth_error = ""
+    # Don't leave the previous user's claim analysis on screen for the next login
+    st.session_state.pop("submitted_query", None)
+    st.session_state.pop("analysis", None)
     st.success("Logged out successfully!")
-    st.rerun()
 
 # --- Streamlit UI ---
-st.set_page_config(page_title="ClauseIQ Dashboard", page_icon="🧠", layout="wide")
+CSS_PATH = os.path.join(APP_DIR, "static", "clauseiq.css")
 
-st.markdown("""
-    <style>
-    /* Overall background with a subtle gradient */
-    body {
-        background: linear-gradient(135deg, #F0F8FF 0%, #E6E6FA 100%); /* Light blue to lavender gradient */
-        background-attachment: fixed; /* Keep gradient fixed on scroll */
-    }
-    /* Main content blocks (cards) */
-    .main, .block-container {
-        background-color: #FFFFFF !important; /* Pure white for cards */
-        border-radius: 25px; /* More rounded corners */
-        padding: 2rem; /* Increased padding */
-        box-shadow: 0 8px 20px rgba(0, 0, 0, 0.08); /* Stronger, softer shadow */
-        margin-bottom: 20px; /* Space between main blocks */
-    }
-    /* Buttons - primary action */
-    .stButton > button {
-        background-color: #6A5ACD; /* A soft, rich purple */
-        color: #fff;
-        border: none;
-        border-radius: 20px; /* Very rounded buttons */
-        padding: 0.8rem 1.6rem;
-        font-size: 17px;
-        font-weight: bold;
-        transition: background-color 0.3s ease, transform 0.2s ease, box-shadow 0.3s ease;
-        box-shadow: 0 6px 12px rgba(106, 90, 205, 0.4); /* Deeper purple shadow */
-        cursor: pointer;
-    }
-    .stButton > button:hover {
-        background-color: #5B42D1; /* Slightly darker purple on hover */
-        transform: translateY(-3px); /* More pronounced lift effect */
-        box-shadow: 0 8px 16px rgba(106, 90, 205, 0.5);
-    }
-    /* Download button - secondary action */
-    .stDownloadButton > button {
-        background-color: #87CEEB; /* A soft sky blue */
-        color: white;
-        border-radius: 20px;
-        padding: 0.8rem 1.6rem;
-        font-size: 17px;
-        font-weight: bold;
-        transition: background-color 0.3s ease, transform 0.2s ease, box-shadow 0.3s ease;
-        box-shadow: 0 6px 12px rgba(135, 206, 235, 0.4); /* Deeper blue shadow */
-        cursor: pointer;
-    }
-    .stDownloadButton > button:hover {
-        background-color: #7AC5E2; /* Slightly darker blue on hover */
-        transform: translateY(-3px);
-        box-shadow: 0 8px 16px rgba(135, 206, 235, 0.5);
-    }
-    /* Text input fields */
-    .stTextInput > div > div > input {
-        border-radius: 18px; /* Rounded input fields */
-        padding: 14px 18px;
-        border: 1px solid #D8BFD8; /* Medium lavender border */
-        background-color: #FDFDFE; /* Very light background */
-        color: #333333; /* Darker text for readability */
-        box-shadow: inset 0 1px 3px rgba(0, 0, 0, 0.05); /* Subtle inner shadow */
-    }
-    .stTextInput > label { /* Style for text input labels */
-        color: #5B42D1; /* Purple label */
-        font-weight: bold;
-    }
-    /* Expander headers */
-    .streamlit-expanderHeader {
-        background-color: #F5EEF8; /* Light pastel purple */
-        border-radius: 18px;
-        padding: 14px 18px;
-        font-weight: bold;
-        color: #5B42D1 !important; /* Purple text for expander header */
-        box-shadow: 0 2px 5px rgba(0, 0, 0, 0.05);
-    }
-    /* General Markdown text */
-    .stMarkdown, .markdown-text-container {
-        font-family: 'Inter', sans-serif; /* Using Inter font for modern look */
-        font-size: 17px;
-        line-height: 1.6;
-        color: #333333 !important; /* Force dark gray for body text */
-    }
-    /* Subheaders and Title */
-    h1, h2, h3, h4, h5, h6 {
-        font-family: 'Inter', sans-serif;
-        color: #483D8B !important; /* Darker royal blue/purple for headings */
-        font-weight: 700; /* Bolder headings */
-    }
-    /* Specific styling for st.caption to ensure readability */
-    div[data-testid="stCaptionContainer"] p {
-        color: #666666 !important; /* Slightly lighter gray for caption text */
-        font-size: 15px;
-    }
-    /* Specific styling for st.metric labels and values */
-    div[data-testid="stMetricLabel"] div {
-        color: #483D8B !important; /* Darker purple for metric labels */
-        font-weight: 600;
-        font-size: 16px;
-    }
-    div[data-testid="stMetricValue"] {
-        color: #333333 !important; /* Dark gray for metric values */
-        font-size: 28px; /* Larger metric values */
-        font-weight: 700;
-    }
+st.set_page_config(page_title="ClauseIQ Dashboard", page_icon="🧠", layout="wide")
 
-    /* Streamlit's default success/info/warning messages */
-    .stAlert {
-        border-radius: 15px; /* Rounded alerts */
-        padding: 15px;
-        font-size: 16px;
-        box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-    }
-    /* Customizing Streamlit's default success message for softer green */
-    .stAlert.success {
-        background-color: #E6F7E6; /* Light pastel green */
-        color: #2F855A; /* Darker green text */
-        border-left: 6px solid #48BB78; /* Green border */
-    }
-    /* Customizing Streamlit's default info message for softer blue */
-    .stAlert.info {
-        background-color: #E0F2F7; /* Light pastel blue */
-        color: #2B6CB0; /* Darker blue text */
-        border-left: 6px solid #4299E1; /* Blue border */
-    }
-    /* Customizing Streamlit's default error message for softer red */
-    .stAlert.error {
-        background-color: #FEE8E8; /* Light pastel red */
-        color: #C53030; /* Darker red text */
-        border-left: 6px solid #E53E3E; /* Red border */
-    }
+@st.cache_data
+def load_css():
+    """Reads the dashboard stylesheet once; later reruns reuse the cached string."""
+    with open(CSS_PATH) as f:
+        return f.read()
 
-    /* Custom style for the login/signup container */
-    .auth-container {
-        background-color: #FFFFFF;
-        border-radius: 25px;
-        padding: 30px;
-        box-shadow: 0 8px 20px rgba(0, 0, 0, 0.08);
-        max-width: 500px;
-        margin: 50px auto; /* Center the container */
-        text-align: center;
-    }
-    .auth-container h2 {
-        color: #483D8B !important;
-        margin-bottom: 20px;
-    }
-    .auth-container .stTextInput {
-        margin-bottom: 15px;
-    }
-    .auth-container .stButton {
-        margin-top: 20px;
-    }
-    </style>
-""", unsafe_allow_html=True)
+# st.html injects the stylesheet as-is, skipping the Markdown parser st.markdown would run it through
+st.html(f"<style>{load_css()}</style>")
 
 # --- Main App Logic ---
 def main_app_page():
@@ -338,9 +663,16 @@ def main_app_page():
             with st.expander("📌 Example Queries"):
                 st.markdown("- My mom had breast surgery after 3 months of insurance, will it be covered?")
                 st.markdown("- Dad's accident-based knee operation, policy started in January. Can we claim?")
-            # Text input field for the user to describe their situation.
-            user_query = st.text_input("Describe your situation:",
-                                         placeholder="e.g. My dad had knee surgery, policy is 3 months old")
+            # Query input inside a form, so typing doesn't rerun the analysis; only "Analyze" submits.
+            with st.form("claim_form"):
+                query_input = st.text_input("Describe your situation:",
+                                             placeholder="e.g. My dad had knee surgery, policy is 3 months old")
+                submitted = st.form_submit_button("Analyze")
+            if submitted:
+                # Remember the submitted query so the LawyerConnect buttons' reruns keep the results on screen.
+                st.session_state.submitted_query = query_input
+                st.session_state.pop("analysis", None) # A fresh submit always re-runs the analysis
+            user_query = st.session_state.get("submitted_query", "")
 
         with right:
             st.subheader("📊 System Status")
@@ -349,17 +681,20 @@ def main_app_page():
             st.metric("Clause Match Confidence", "97.6%") # Placeholder for confidence level
             st.metric("Uptime", "100%") # Placeholder for system uptime
 
-    # Conditional display of results once a user query is entered.
+    # Conditional display of results once a user query is submitted.
     if user_query:
-        # Show a spinner while the AI is processing the query.
-        with st.spinner("🔍 Analyzing your policy..."):
-            top_clauses = get_top_clause(user_query)
-            decision = get_llm_decision(user_query, top_clauses)
-            try:
-                parsed = json.loads(decision)
-            except json.JSONDecodeError:
-                st.error("Failed to parse JSON response from Gemini. Please try again.")
-                parsed = {"decision": "error", "reason": "Invalid JSON response", "counterclause": "", "clause_reference": ""}
+        analysis = st.session_state.get("analysis")
+        if analysis is None:
+            # Show a spinner while the AI is processing the query.
+            with st.spinner("🔍 Analyzing your policy..."):
+                top_clauses = get_top_clause(user_query)
+                stream_box = st.empty() # Shows Gemini's answer as it streams in
+                parsed = get_llm_decision(user_query, tuple(top_clauses), stream_box)
+                stream_box.empty()
+            # Keep the result so reruns from the LawyerConnect buttons don't re-enter the analysis.
+            st.session_state.analysis = {"top_clauses": top_clauses, "parsed": parsed}
+        else:
+            top_clauses, parsed = analysis["top_clauses"], analysis["parsed"]
 
         st.success("✅ AI Decision Complete")
 
@@ -379,20 +714,21 @@ def main_app_page():
         col3, col4 = st.columns([1, 1])
         with col3:
             if st.button("🔗 Book Legal Review"):
+                # The case file is the analysis already on screen; escalating makes no further Gemini call.
                 st.success("A legal advisor will reach out soon. Your case file is summarized below.")
 
         with col4:
-            if st.button("📤 Export Summary"):
-                summary = f"""
-                CLAIM CASE SUMMARY
-
-                User Query: {user_query}
-                Decision: {parsed['decision']}
-                Reason: {parsed['reason']}
-                Suggested Rebuttal: {parsed['counterclause']}
-                Referenced Clause: {parsed['clause_reference']}
-                """
-                st.download_button("Download Summary", summary, file_name="claim_summary.txt")
+            # Built from the stored analysis, so exporting is a single click with no extra rerun.
+            summary = f"""
+            CLAIM CASE SUMMARY
+
+            User Query: {user_query}
+            Decision: {parsed['decision']}
+            Reason: {parsed['reason']}
+            Suggested Rebuttal: {parsed['counterclause']}
+            Referenced Clause: {parsed['clause_reference']}
+            """
+            st.download_button("📤 Export Summary", summary, file_name="claim_summary.txt")
 
     # Logout button
     st.sidebar.button("Logout", on_click=logout_user)
@@ -411,8 +747,9 @@ def login_page():
 
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("Login", key="login_btn"):
-            login_user(email, password)
+        # Read the inputs when the callback fires, not when the button was rendered
+        st.button("Login", key="login_btn",
+                  on_click=lambda: login_user(st.session_state.auth_email, st.session_state.auth_password))
     with col2:
         if st.button("Create Account", key="create_account_btn"):
             create_account(email, password)
@@ -430,18 +767,20 @@ def login_page():
 
 # --- Main App Entry Point ---
 # Check if Firebase is initialized and if an initial auth token is available (from Canvas environment)
-if st.session_state.firebase_initialized and '__initial_auth_token' in globals() and __initial_auth_token and not st.session_state.logged_in:
+# auth_attempted stops a failed sign-in from calling Firebase again on every rerun.
+if not st.session_state.auth_attempted and st.session_state.firebase_initialized and '__initial_auth_token' in globals() and __initial_auth_token and not st.session_state.logged_in:
     # Attempt to sign in with the provided custom token
+    st.session_state.auth_attempted = True
     try:
         user = auth.sign_in_with_custom_token(__initial_auth_token)
         st.session_state.logged_in = True
         st.session_state.user_id = user.uid
         st.success(f"Automatically logged in as {st.session_state.user_id}")
-        st.rerun() # Rerun to switch to main app page
     except Exception as e:
         st.session_state.auth_error = f"Automatic login failed: {e}"
-        login_page() # Show login page if auto-login fails
-elif st.session_state.logged_in:
+
+# Render the right page in this same run; no extra st.rerun() after signing in.
+if st.session_state.logged_in:
     main_app_page()
 else:
     login_page()